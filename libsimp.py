@@ -2,10 +2,21 @@
 # -*- coding: utf-8 -*-
 
 
+import json
+import math
+import os
+import sys
 from time import sleep
 
-import ftd2xx
-from ftd2xx.defines import *
+
+# The ftd2xx driver is imported on the first connection attempt rather than at
+# import time. Loading the D2XX library is slow, and the command line interface
+# should not pay for it just to print help or validate its arguments.
+ftd2xx = None
+
+# Buffer purge masks, matching ftd2xx.defines.
+PURGE_RX = 1
+PURGE_TX = 2
 
 
 # Device operation code definitions.
@@ -61,29 +72,49 @@ DUT_MEASUREMENT_RANGE_TABLE = {
     4: b'\x00'
 }
 FG_MEASURMENT_VREF = 2.5
+MEASUREMENT_BITS = 12
+
+# Calibration definitions.
+# Measurement channels that can be calibrated. The DUT channel is calibrated per range.
+CALIBRATION_CHANNELS = ('fg', 'dut', 'ps')
+# Fitted corrections outside these limits need to be confirmed before they are saved.
+CALIBRATION_GAIN_MIN = 0.8
+CALIBRATION_GAIN_MAX = 1.2
+CALIBRATION_OFFSET_MAX = 0.1 # Fraction of the channel's full scale.
+CALIBRATION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simps_calibration.json')
 
 
 class SIMPS(object):
     # Wrapper around SIMPSDevice to be able to use the 'with' style.
-    def __init__(self, connect_timeout=None):
+    def __init__(self, connect_timeout=None, calibration_file=CALIBRATION_FILE):
         self.connect_timeout = connect_timeout
+        self.calibration_file = calibration_file
         
     def __enter__(self):
-        self.device = SIMPSDevice(self.connect_timeout)
-        self.device.connect()
+        self.device = SIMPSDevice(self.connect_timeout, self.calibration_file)
+        try:
+            self.device.connect()
+        except:
+            # __exit__ is not called when __enter__ fails, so do not leak the handle.
+            self.device.close()
+            raise
         return self.device
     
     def __exit__(self, exc_type, exc_value, traceback):
         self.device.close()
 
 class SIMPSDevice(object):
-    def __init__(self, connect_timeout=None):
+    def __init__(self, connect_timeout=None, calibration_file=CALIBRATION_FILE):
         self.device = None
+        self.serial = None
         self.range = 1
-        self.range_mult = 1.1
         self.connect_timeout = connect_timeout
+        self.calibration_file = calibration_file
+        self.calibration = None
     
     def connect(self):
+        load_ftd2xx()
+        
         time = 0
         while True:
             try:
@@ -99,6 +130,7 @@ class SIMPSDevice(object):
                 
                 # Lets make a connection to the simp.
                 self.device = ftd2xx.open(devices[0]['index'])
+                self.serial = devices[0]['serial'].decode('ascii', 'replace')
                 
                 # Reset Device
                 self.device.resetDevice()
@@ -144,6 +176,10 @@ class SIMPSDevice(object):
             else:
                 # The connection was successful, so break the loop.
                 break
+        
+        # Load this device's calibration, if it has one.
+        if self.calibration_file:
+            self.calibration = load_calibration(self.calibration_file, self.serial)
                 
     
     def close(self):
@@ -369,14 +405,12 @@ class SIMPSDevice(object):
         
         assert (_range > 0) and (_range < 5)
         self.range = _range
-        
-        self.range_mult = DUT_MEASUREMENT_RANGE_MULTIPLIERS[self.range-1]
         return self.range
     
     def range_byte(self, _range):
-        # Check and generate the range byte. Also set the measurement multiplier.
+        # Check and generate the range byte. The range's multiplier is applied
+        # by the DUT measurement lookup table.
         assert (_range > 0) and (_range < 5)
-        self.range_mult = DUT_MEASUREMENT_RANGE_MULTIPLIERS[_range-1]
         return DUT_MEASUREMENT_RANGE_TABLE[_range]
     
     def set_range(self, _range):
@@ -400,24 +434,211 @@ class SIMPSDevice(object):
         
         assert (response != None)
         
+        # Split the response into 12-bit codes and convert them with the lookup tables.
+        # The top nibble of each code is always zero, so a set bit means a corrupt frame.
+        codes = [(response[i] << 8) | response[i+1] for i in range(0, len(response), 2)]
+        assert all(code < 2**MEASUREMENT_BITS for code in codes)
+        samples = MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS
+        
         # Function Generater Measurements
-        fg_measurements = []
-        for i in range(MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS):
-            start = i*2
-            end = (i*2) + 2
-            fg_measurements.append(bytes_to_voltage(response[start:end], FG_MEASURMENT_VREF, 12, bipolar=True))
+        fg_table = self.measurement_table('fg')
+        fg_measurements = [fg_table[code] for code in codes[:samples]]
         
         # DUT Output Measurements
-        dut_measurements = []
-        for i in range(MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS):
-            start = i*2 + 48
-            end = (i*2) + 2 + 48
-            dut_measurements.append((self.range_mult * bytes_to_voltage(response[start:end], DUT_MEASUREMENT_VREF, 12, bipolar=True)))
+        dut_table = self.measurement_table('dut', self.range)
+        dut_measurements = [dut_table[code] for code in codes[samples:2*samples]]
         
         # Power Supply Voltage Feedback
-        ps_voltage = bytes_to_voltage(response[96:98], POWERSUPPLY_VREF, 12)
+        ps_voltage = self.measurement_table('ps')[codes[2*samples]]
         
         return (fg_measurements, dut_measurements, ps_voltage)
+    
+    def measurement_table(self, channel, _range=None):
+        # Code to voltage lookup table, calibrated when the device has a calibration.
+        if self.calibration: return self.calibration.table(channel, _range)
+        return ideal_table(channel, _range)
+
+class Calibration(object):
+    # Gain, offset and optional nonlinearity corrections for one device. Each
+    # correction maps the ideal voltage of a channel, and range for the DUT
+    # channel, to the true voltage:
+    #     v = offset + gain*ideal + nonlinearity[0]*ideal^2 + nonlinearity[1]*ideal^3 ...
+    # The corrections are stored in the calibration file by device serial number:
+    #     {"<serial>": {"fg": {"gain": 1.0, "offset": 0.0},
+    #                   "dut": {"1": {"gain": 1.0, "offset": 0.0, "nonlinearity": [0.0]}},
+    #                   "ps": {"gain": 1.0, "offset": 0.0}}}
+    def __init__(self, serial, corrections=None):
+        self.serial = serial
+        self.corrections = corrections if corrections else {}
+        self.tables = {}
+    
+    def correction(self, channel, _range=None):
+        assert channel in CALIBRATION_CHANNELS
+        correction = self.corrections.get(channel)
+        if (channel == 'dut') and correction:
+            correction = correction.get(str(_range))
+        return correction
+    
+    def set_correction(self, channel, _range, gain, offset, nonlinearity=None):
+        assert channel in CALIBRATION_CHANNELS
+        correction = {'gain': gain, 'offset': offset}
+        if nonlinearity: correction['nonlinearity'] = list(nonlinearity)
+        
+        if (channel == 'dut'):
+            assert (_range > 0) and (_range < 5)
+            self.corrections.setdefault('dut', {})[str(_range)] = correction
+        else:
+            self.corrections[channel] = correction
+        
+        # The lookup table for this channel has to be rebuilt.
+        self.tables.pop((channel, _range if channel == 'dut' else None), None)
+    
+    def table(self, channel, _range=None):
+        # Build the lookup table once, then reuse it for every measurement.
+        if (channel != 'dut'): _range = None
+        key = (channel, _range)
+        if key not in self.tables:
+            ideal = ideal_table(channel, _range)
+            correction = self.correction(channel, _range)
+            if correction:
+                self.tables[key] = [correct_voltage(v, correction) for v in ideal]
+            else:
+                self.tables[key] = ideal
+        return self.tables[key]
+    
+    def save(self, path=CALIBRATION_FILE):
+        # Update this device's entry, keeping the other devices in the file.
+        calibrations = {}
+        if os.path.exists(path):
+            try:
+                with open(path) as calibration_file:
+                    calibrations = json.load(calibration_file)
+                if not isinstance(calibrations, dict): raise ValueError('expected an object of device serial numbers')
+            except ValueError as e:
+                # Keep the unreadable file for inspection rather than overwriting it.
+                os.replace(path, path + '.bad')
+                print('Warning: moved unreadable calibration file %s to %s.bad: %s' % (path, path, e), file=sys.stderr)
+                calibrations = {}
+        calibrations[self.serial] = self.corrections
+        
+        with open(path, 'w') as calibration_file:
+            json.dump(calibrations, calibration_file, indent=4, sort_keys=True)
+        
+        _calibration_cache[(path, self.serial)] = (os.path.getmtime(path), self)
+
+# Loaded calibrations by file and serial, so that reconnecting (e.g. every call
+# from LabVIEW) does not re-read the file and rebuild the lookup tables.
+_calibration_cache = {}
+
+def load_calibration(path, serial):
+    # Returns the device's calibration, or None if the file has no entry for it.
+    # A bad calibration file must not stop the device from being used, so it
+    # is reported and the ideal conversion is used instead.
+    try:
+        if not os.path.exists(path): return None
+        
+        mtime = os.path.getmtime(path)
+        cached = _calibration_cache.get((path, serial))
+        if cached and (cached[0] == mtime): return cached[1]
+        
+        with open(path) as calibration_file:
+            calibrations = json.load(calibration_file)
+        if not isinstance(calibrations, dict): raise ValueError('expected an object of device serial numbers')
+        corrections = calibrations.get(serial)
+        if corrections: check_corrections(corrections)
+    except (OSError, ValueError) as e:
+        print('Warning: ignoring calibration file %s: %s' % (path, e), file=sys.stderr)
+        return None
+    
+    calibration = Calibration(serial, corrections) if corrections else None
+    _calibration_cache[(path, serial)] = (mtime, calibration)
+    return calibration
+
+def is_finite_number(value):
+    # JSON allows NaN and Infinity, and bools load as ints, so check for both.
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+def check_corrections(corrections):
+    # Raise ValueError unless the corrections have the layout documented in Calibration.
+    def check(correction, name):
+        if not isinstance(correction, dict): raise ValueError('%s is not an object' % name)
+        for key in correction:
+            if key not in ('gain', 'offset', 'nonlinearity'): raise ValueError('unknown %s key %r' % (name, key))
+        for key in ('gain', 'offset'):
+            if not is_finite_number(correction.get(key)):
+                raise ValueError('%s needs a finite numeric %s' % (name, key))
+        nonlinearity = correction.get('nonlinearity', [])
+        if not isinstance(nonlinearity, list) or not all(is_finite_number(c) for c in nonlinearity):
+            raise ValueError('%s nonlinearity is not a list of finite numbers' % name)
+    
+    if not isinstance(corrections, dict): raise ValueError('device entry is not an object')
+    for channel in corrections:
+        if channel not in CALIBRATION_CHANNELS: raise ValueError('unknown channel %r' % channel)
+        if (channel == 'dut'):
+            if not isinstance(corrections['dut'], dict): raise ValueError('dut is not an object of ranges')
+            for _range in corrections['dut']:
+                if _range not in ('1', '2', '3', '4'): raise ValueError('unknown dut range %r' % _range)
+                check(corrections['dut'][_range], 'dut range %s' % _range)
+        else:
+            check(corrections[channel], channel)
+
+# Ideal code to voltage lookup tables by channel and range.
+_ideal_tables = {}
+
+def ideal_table(channel, _range=None):
+    # Precompute the ideal voltage for every measurement code.
+    if (channel != 'dut'): _range = None
+    key = (channel, _range)
+    if key not in _ideal_tables:
+        codes = [int.to_bytes(code, length=2, byteorder='big', signed=False) for code in range(2**MEASUREMENT_BITS)]
+        if (channel == 'fg'):
+            table = [bytes_to_voltage(b, FG_MEASURMENT_VREF, MEASUREMENT_BITS, bipolar=True) for b in codes]
+        elif (channel == 'dut'):
+            assert (_range > 0) and (_range < 5)
+            multiplier = DUT_MEASUREMENT_RANGE_MULTIPLIERS[_range-1]
+            table = [multiplier * bytes_to_voltage(b, DUT_MEASUREMENT_VREF, MEASUREMENT_BITS, bipolar=True) for b in codes]
+        elif (channel == 'ps'):
+            table = [bytes_to_voltage(b, POWERSUPPLY_VREF, MEASUREMENT_BITS) for b in codes]
+        else:
+            raise ValueError('Unknown measurement channel %r' % channel)
+        _ideal_tables[key] = table
+    return _ideal_tables[key]
+
+def correct_voltage(v, correction):
+    # Apply a calibration correction to an ideal voltage.
+    corrected = correction['offset'] + correction['gain'] * v
+    for power, coefficient in enumerate(correction.get('nonlinearity', []), 2):
+        corrected += coefficient * (v ** power)
+    return corrected
+
+def fit_correction(ideal, actual, order=1):
+    # Least squares fit of actual = offset + gain*ideal + ... up to the given
+    # polynomial order. Returns (gain, offset, nonlinearity).
+    assert len(ideal) == len(actual)
+    assert (order >= 1) and (len(ideal) > order)
+    
+    # Solve the normal equations with Gauss-Jordan elimination.
+    size = order + 1
+    matrix = [[sum(x ** (row + column) for x in ideal) for column in range(size)] + [sum(y * (x ** row) for x, y in zip(ideal, actual))] for row in range(size)]
+    for column in range(size):
+        pivot = max(range(column, size), key=lambda row: abs(matrix[row][column]))
+        if (matrix[pivot][column] == 0): raise ValueError('Calibration points must be at different voltages.')
+        matrix[column], matrix[pivot] = matrix[pivot], matrix[column]
+        for row in range(size):
+            if (row != column):
+                factor = matrix[row][column] / matrix[column][column]
+                matrix[row] = [a - factor*b for a, b in zip(matrix[row], matrix[column])]
+    coefficients = [matrix[row][size] / matrix[row][row] for row in range(size)]
+    
+    return coefficients[1], coefficients[0], coefficients[2:]
+
+def load_ftd2xx():
+    # Import the ftd2xx driver once and share it with the rest of the module.
+    global ftd2xx
+    if (ftd2xx == None):
+        import ftd2xx as _ftd2xx
+        ftd2xx = _ftd2xx
+    return ftd2xx
 
 def voltage_to_bytes(v, ref, n=12, bipolar=False):
     if (bipolar == True):
@@ -2,8 +2,11 @@
 # -*- coding: utf-8 -*-
 
 import argparse
+import shlex
+import sys
 
-from libsimp import SIMPS, WAVEFORM_SAMPLES_PER_PERIOD, POWERSUPPLY_MIN, POWERSUPPLY_MAX, MEASUREMENT_SAMPLES, MEASUREMENT_PERIODS
+from libsimp import SIMPS, Calibration, fit_correction, correct_voltage, ideal_table, CALIBRATION_CHANNELS, CALIBRATION_GAIN_MIN, CALIBRATION_GAIN_MAX, CALIBRATION_OFFSET_MAX, WAVEFORM_SAMPLES_PER_PERIOD, POWERSUPPLY_MIN, POWERSUPPLY_MAX, MEASUREMENT_SAMPLES, MEASUREMENT_PERIODS
+from simps_limits import load_plan, test_unit, format_verdict, write_verdict, VERDICT_PASS
 
 
 def cli():
@@ -20,6 +23,44 @@ def cli():
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter, description='Command line interface for the\n'+header)
     subparsers = parser.add_subparsers(help='sub-command help', dest='action')
     
+    add_device_subparsers(subparsers)
+    
+    sub_verification = subparsers.add_parser('debug', help='debug the device')
+    group_verification = sub_verification.add_mutually_exclusive_group(required=True)
+    group_verification.add_argument('-v', '--validate_communications', action='store_true', help='validate communications with the FPGA')
+    sub_verification.set_defaults(func=device_action)
+    
+    sub_test = subparsers.add_parser('test', help='production test units against a limit table')
+    sub_test.add_argument('plan', help='JSON test plan with the test points and their limits')
+    sub_test.add_argument('-u', '--units', nargs='+', metavar='UNIT', help='unit serial numbers; you are prompted to insert each unit', required=True)
+    sub_test.add_argument('-o', '--output', metavar='FILE', help='append a JSON verdict record per unit to FILE')
+    sub_test.set_defaults(func=test_action)
+    
+    sub_cal = subparsers.add_parser('calibrate', help='calibrate a measurement channel against a reference meter')
+    sub_cal.add_argument('-c', '--channel', choices=CALIBRATION_CHANNELS, help='measurement channel; fg: function generator, dut: DUT output, ps: powersupply feedback', required=True)
+    sub_cal.add_argument('-r', '--range', type=int, choices=range(1,5), help='measurement range to calibrate, required for the dut channel')
+    sub_cal.add_argument('-V', '--voltages', type=float, nargs='+', metavar='V', help='reference voltages to calibrate at', required=True)
+    sub_cal.add_argument('-n', '--measurements', type=int, default=4, help='measurements averaged per reference voltage; default 4')
+    sub_cal.add_argument('--order', type=int, choices=range(1,4), default=1, help='1: gain and offset, 2-3: also correct nonlinearity; default 1')
+    sub_cal.set_defaults(func=calibrate_action)
+    
+    sub_run = subparsers.add_parser('run', help='run a script of sub-commands over a single connection')
+    sub_run.add_argument('script', nargs='?', default='-', help='file with one sub-command per line, e.g. "ps --enable"; reads stdin when omitted or "-"')
+    sub_run.set_defaults(func=script_action)
+    
+    sub_shell = subparsers.add_parser('shell', help='interactive shell running sub-commands over a single connection')
+    sub_shell.set_defaults(func=shell_action)
+    
+    #parser.add_argument('waveform_values', metavar='V', type=int, nargs='+', help='an integer for the accumulator')
+    #parser.add_argument('--sum', dest='accumulate', action='store_const', const=sum, default=max, help='sum the integers (default: find the max)')
+    
+    args = parser.parse_args()
+    if args.action: args.func(args)
+    else: parser.print_help()
+
+def add_device_subparsers(subparsers):
+    # Sub-commands that talk to an open device. These are shared by the command
+    # line and by the script and shell modes.
     sub_program = subparsers.add_parser('program', help='program the device')
     sub_program.add_argument('-p', '--ps_voltage', type=int, help='powersupply voltage; 0-60V', required=True)
     sub_program.add_argument('-w', '--waveform', type=int, nargs=WAVEFORM_SAMPLES_PER_PERIOD, metavar='P', help='waveform period values', required=True)
@@ -50,18 +91,32 @@ def cli():
     sub_mo = subparsers.add_parser('mode', help='mode options')
     sub_mo.add_argument('-g', '--get-mode', action='store_true', help='get the devices current mode of operation', required=True)
     sub_mo.set_defaults(func=device_action)
+
+def command_parser():
+    # Parser for a single line of a script or shell session.
+    parser = argparse.ArgumentParser(prog='simps', description='Sub-commands run over the open SIMPS ATE connection. Use "exit" to leave the shell.')
+    subparsers = parser.add_subparsers(help='sub-command help', dest='action')
+    add_device_subparsers(subparsers)
+    return parser
+
+def parse_command(parser, line):
+    # Split a line like a shell would, ignoring blank lines and # comments.
+    words = shlex.split(line, comments=True)
+    if (len(words) == 0): return None
     
-    sub_verification = subparsers.add_parser('debug', help='debug the device')
-    group_verification = sub_verification.add_mutually_exclusive_group(required=True)
-    group_verification.add_argument('-v', '--validate_communications', action='store_true', help='validate communications with the FPGA')
-    sub_verification.set_defaults(func=device_action)
-    
-    #parser.add_argument('waveform_values', metavar='V', type=int, nargs='+', help='an integer for the accumulator')
-    #parser.add_argument('--sum', dest='accumulate', action='store_const', const=sum, default=max, help='sum the integers (default: find the max)')
-    
-    args = parser.parse_args()
-    if args.action: args.func(args)
-    else: parser.print_help()
+    # Argparse exits on bad input, so turn that into an exception the caller can
+    # handle. A zero exit status means help was printed, which is not an error.
+    try:
+        args = parser.parse_args(words)
+    except SystemExit as e:
+        if not e.code: return None
+        raise ValueError('invalid command: %s' % line.strip())
+    if not args.action: raise ValueError('missing sub-command: %s' % line.strip())
+    return args
+
+def error_text(e):
+    # Asserts usually have no message, so fall back to the exception's name.
+    return str(e) if str(e) else type(e).__name__
 
 def restricted_float(x, min, max):
     try:
@@ -74,35 +129,218 @@ def restricted_float(x, min, max):
 
 def device_action(args):
     with SIMPS() as device:
-        if (args.action == 'ps') and (args.enable == True):
-            device.enable_ps()
-        elif (args.action == 'ps') and (args.disable == True):
-            device.disable_ps()
-        elif (args.action == 'fg') and (args.enable == True):
-            device.enable_fg()
-        elif (args.action == 'fg') and (args.disable == True):
-            device.disable_fg()
-        elif (args.action == 'measurement') and (args.range != None):
-            device.set_range(args.range)
-        elif (args.action == 'measurement') and (args.get_range == True):
-            print('The SIMPS ATE device is in measurement range %i.' % device.get_range())
-        elif (args.action == 'debug') and (args.validate_communications == True):
-            device.validate_communications()
-        elif (args.action == 'mode'):
-            print('The SIMPS ATE device is operating in the %s mode.' % device.get_mode())
-        elif (args.action == 'ps') and (args.set_voltage != None):
-            device.set_ps(args.set_voltage)
-        elif (args.action == 'program'):
-            device.program(args.ps_voltage, args.frequency, args.waveform, args.range)
-        elif (args.action == 'measurement') and (args.take_measurement == True):
-            fg_measurements, dut_measurements, ps_voltage = device.measurement()
-            print('\n----- Current power supply voltage: %r' % ps_voltage)
-            print('\n----- DUT measurements:')
-            for i in range(MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS):
-                print('\t%i: %r' % (i, round(dut_measurements[i], 4)))
-            print('\n----- Function generator measurements:')
-            for i in range(MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS):
-                print('\t%i: %r' % (i, round(fg_measurements[i], 4)))
+        run_action(device, args)
+
+def script_action(args):
+    parser = command_parser()
+    
+    if (args.script == '-'):
+        name = '<stdin>'
+        lines = sys.stdin.readlines()
+    else:
+        name = args.script
+        with open(args.script) as script:
+            lines = script.readlines()
+    
+    # Validate the whole script before connecting so that a typo on the last
+    # line does not leave the device half configured.
+    commands = []
+    for number, line in enumerate(lines, 1):
+        try:
+            command = parse_command(parser, line)
+        except ValueError as e:
+            print('%s:%i: %s' % (name, number, e), file=sys.stderr)
+            exit(2)
+        if command: commands.append((number, command))
+    
+    if (len(commands) == 0): return
+    
+    with SIMPS() as device:
+        for number, command in commands:
+            try:
+                run_action(device, command)
+            except Exception as e:
+                # Stop at the failing line; leaving the with block closes the device.
+                print('%s:%i: error: %s' % (name, number, error_text(e)), file=sys.stderr)
+                exit(1)
+
+def shell_action(args):
+    # Line editing and history where the platform provides it.
+    try:
+        import readline
+    except ImportError:
+        pass
+    
+    parser = command_parser()
+    
+    with SIMPS() as device:
+        print('Connected to the SIMPS ATE device. Type "help" for sub-commands or "exit" to quit.')
+        while True:
+            try:
+                line = input('simps> ')
+            except EOFError:
+                print()
+                break
+            except KeyboardInterrupt:
+                print()
+                continue
+            
+            if line.strip() in ('exit', 'quit'): break
+            if line.strip() == 'help':
+                parser.print_help()
+                continue
+            
+            try:
+                command = parse_command(parser, line)
+            except ValueError as e:
+                print('Error: %s' % error_text(e))
+                continue
+            if not command: continue
+            
+            # Keep the session alive if a single command fails.
+            try:
+                run_action(device, command)
+            except Exception as e:
+                print('Error: %s' % error_text(e))
+
+def test_action(args):
+    # Compile the plan before connecting so bad limits are caught up front.
+    try:
+        test_points = load_plan(args.plan)
+    except ValueError as e:
+        print('%s: %s' % (args.plan, e), file=sys.stderr)
+        exit(2)
+    
+    failed = 0
+    with SIMPS() as device:
+        for unit in args.units:
+            if (len(args.units) > 1): input('Insert unit %s and press Enter to test.' % unit)
+            record = test_unit(device, test_points, unit)
+            print(format_verdict(record))
+            if args.output: write_verdict(args.output, record)
+            if (record['verdict'] != VERDICT_PASS): failed += 1
+    
+    print('\n----- %i of %i units passed.' % (len(args.units) - failed, len(args.units)))
+    if failed: exit(1)
+
+def calibrate_action(args):
+    # Check the arguments before connecting.
+    error = None
+    if (args.channel == 'dut') and (args.range == None):
+        error = 'the dut channel needs a measurement range, -r'
+    elif (args.measurements < 1):
+        error = 'at least 1 measurement per reference voltage is needed, -n'
+    elif (len(args.voltages) <= args.order):
+        error = 'an order %i fit needs at least %i reference voltages' % (args.order, args.order + 1)
+    elif (args.channel == 'ps') and any((v < POWERSUPPLY_MIN) or (v > POWERSUPPLY_MAX) for v in args.voltages):
+        error = 'powersupply reference voltages must be in range [%r, %r]' % (POWERSUPPLY_MIN, POWERSUPPLY_MAX)
+    elif (args.channel == 'ps') and any(v != int(v) for v in args.voltages):
+        # The powersupply is only programmed in whole volts.
+        error = 'powersupply reference voltages must be whole volts'
+    if error:
+        print('simps_cli.py calibrate: error: %s' % error, file=sys.stderr)
+        exit(2)
+    
+    with SIMPS() as device:
+        calibration = device.calibration if device.calibration else Calibration(device.serial)
+        
+        # Measure with the ideal conversion so an existing calibration does not skew the fit.
+        device.calibration = None
+        if (args.channel == 'dut'): device.set_range(args.range)
+        
+        ideal = []
+        actual = []
+        try:
+            for voltage in args.voltages:
+                if (args.channel == 'ps'):
+                    device.set_ps(voltage)
+                    device.enable_ps()
+                    prompt = 'Measure the powersupply output (set to %iV)' % voltage
+                elif (args.channel == 'fg'):
+                    prompt = 'Apply %rV DC to the function generator measurement' % voltage
+                else:
+                    prompt = 'Apply %rV DC to the DUT measurement input' % voltage
+                
+                # The powersupply's own setpoint error is part of what is being
+                # calibrated, so its reading has no default.
+                default = None if (args.channel == 'ps') else voltage
+                while True:
+                    if (default == None): reading = input('%s, then enter the reference meter reading: ' % prompt)
+                    else: reading = input('%s, then enter the reference meter reading [%r]: ' % (prompt, default))
+                    try:
+                        actual.append(float(reading) if (reading.strip() or default == None) else default)
+                        break
+                    except ValueError:
+                        print('%r is not a voltage.' % reading)
+                
+                readings = []
+                for i in range(args.measurements):
+                    fg_measurements, dut_measurements, ps_voltage = device.measurement()
+                    readings += {'fg': fg_measurements, 'dut': dut_measurements, 'ps': [ps_voltage]}[args.channel]
+                ideal.append(sum(readings) / len(readings))
+                print('\tmeasured %r' % round(ideal[-1], 4))
+        finally:
+            # Never leave the powersupply on, even if the operator aborts.
+            if (args.channel == 'ps'): device.disable_ps()
+        
+        try:
+            gain, offset, nonlinearity = fit_correction(ideal, actual, args.order)
+        except ValueError as e:
+            print('simps_cli.py calibrate: error: %s' % e, file=sys.stderr)
+            exit(1)
+        
+        # Show how well the correction fits each reference voltage.
+        correction = {'gain': gain, 'offset': offset, 'nonlinearity': nonlinearity}
+        print('\n----- Fit residuals:')
+        for measured, reference in zip(ideal, actual):
+            print('\t%r V: %r' % (reference, round(reference - correct_voltage(measured, correction), 4)))
+        
+        # A mistyped meter reading gives a wild fit that would then be applied
+        # to every measurement, so make the operator confirm it.
+        full_scale = max(abs(v) for v in ideal_table(args.channel, args.range))
+        if not (CALIBRATION_GAIN_MIN <= gain <= CALIBRATION_GAIN_MAX) or (abs(offset) > CALIBRATION_OFFSET_MAX * full_scale):
+            print('Warning: gain %r or offset %r is outside the expected gain range [%r, %r] or offset of %r V.'
+                % (gain, offset, CALIBRATION_GAIN_MIN, CALIBRATION_GAIN_MAX, round(CALIBRATION_OFFSET_MAX * full_scale, 4)))
+            if (input('Save this calibration anyway? [y/N]: ').strip().lower() != 'y'):
+                print('The calibration was not saved.')
+                exit(1)
+        
+        calibration.set_correction(args.channel, args.range, gain, offset, nonlinearity)
+        calibration.save(device.calibration_file)
+        
+        print('\n----- Calibrated %s for device %s: gain %r, offset %r' % (args.channel if args.channel != 'dut' else 'dut range %i' % args.range, device.serial, gain, offset))
+        if nonlinearity: print('\tnonlinearity: %r' % nonlinearity)
+
+def run_action(device, args):
+    if (args.action == 'ps') and (args.enable == True):
+        device.enable_ps()
+    elif (args.action == 'ps') and (args.disable == True):
+        device.disable_ps()
+    elif (args.action == 'fg') and (args.enable == True):
+        device.enable_fg()
+    elif (args.action == 'fg') and (args.disable == True):
+        device.disable_fg()
+    elif (args.action == 'measurement') and (args.range != None):
+        device.set_range(args.range)
+    elif (args.action == 'measurement') and (args.get_range == True):
+        print('The SIMPS ATE device is in measurement range %i.' % device.get_range())
+    elif (args.action == 'debug') and (args.validate_communications == True):
+        device.validate_communications()
+    elif (args.action == 'mode'):
+        print('The SIMPS ATE device is operating in the %s mode.' % device.get_mode())
+    elif (args.action == 'ps') and (args.set_voltage != None):
+        device.set_ps(args.set_voltage)
+    elif (args.action == 'program'):
+        device.program(args.ps_voltage, args.frequency, args.waveform, args.range)
+    elif (args.action == 'measurement') and (args.take_measurement == True):
+        fg_measurements, dut_measurements, ps_voltage = device.measurement()
+        print('\n----- Current power supply voltage: %r' % ps_voltage)
+        print('\n----- DUT measurements:')
+        for i in range(MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS):
+            print('\t%i: %r' % (i, round(dut_measurements[i], 4)))
+        print('\n----- Function generator measurements:')
+        for i in range(MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS):
+            print('\t%i: %r' % (i, round(fg_measurements[i], 4)))
 
 if (__name__ == '__main__'):
     cli()
\ No newline at end of file
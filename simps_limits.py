@@ -0,0 +1,275 @@
+#!/bin/env python3
+# -*- coding: utf-8 -*-
+
+
+import json
+import math
+from time import sleep
+
+from libsimp import WAVEFORM_SAMPLES_PER_PERIOD, WAVEFORM_VREF, POWERSUPPLY_MIN, POWERSUPPLY_MAX, MEASUREMENT_SAMPLES, MEASUREMENT_PERIODS, DUT_MEASUREMENT_RANGE_TABLE
+
+
+# Pass/fail limit tables for production testing of DUTs.
+#
+# A test plan is a JSON file with a list of test points. Each test point is
+# programmed into the device, measured once and checked against its limits:
+#
+# {
+#     "test_points": [
+#         {
+#             "name": "12V 1kHz",
+#             "ps_voltage": 12, "frequency": 1000, "range": 2,
+#             "waveform": [0, 2, 4, 2, 0, -2, -4, -2],
+#             "settle": 0.1,
+#             "hard": true,
+#             "limits": {
+#                 "dut": {"samples": {"min": -5.0, "max": 5.0}, "amplitude": {"min": 7.5, "max": 8.5}},
+#                 "fg": {"amplitude": {"min": 1.8, "max": 2.2}},
+#                 "ps": {"min": 11.5, "max": 12.5}
+#             }
+#         }
+#     ]
+# }
+#
+# Sample limits are either a single value for every sample or a list with one
+# value per sample. The "mean" and "amplitude" (peak-to-peak) metrics can be
+# limited for the DUT and FG channels. A missing bound is not checked. A
+# failure on a "hard" test point, the default, aborts the rest of the plan.
+# A device error while testing a unit gives that unit an ERROR verdict.
+
+VERDICT_PASS = 'PASS'
+VERDICT_FAIL = 'FAIL'
+VERDICT_ERROR = 'ERROR'
+
+# The frequency is programmed as a 24-bit value.
+FREQUENCY_MAX = 2**24 - 1
+
+# Layout of a measurement frame as checked against the compiled limits.
+FRAME_SAMPLES = MEASUREMENT_SAMPLES*MEASUREMENT_PERIODS
+CHANNELS = ('fg', 'dut')
+METRICS = ('mean', 'amplitude')
+FRAME_LABELS = (
+    ['fg[%i]' % i for i in range(FRAME_SAMPLES)]
+    + ['dut[%i]' % i for i in range(FRAME_SAMPLES)]
+    + ['ps']
+    + ['%s.%s' % (channel, metric) for channel in CHANNELS for metric in METRICS]
+)
+FRAME_LENGTH = len(FRAME_LABELS)
+
+
+class TestPoint(object):
+    # A test point with its limits compiled into lower and upper bound arrays
+    # that line up with the measurement frame.
+    def __init__(self, name, ps_voltage, frequency, waveform, _range, lower, upper, settle=0, hard=True):
+        assert len(waveform) == WAVEFORM_SAMPLES_PER_PERIOD
+        assert (len(lower) == FRAME_LENGTH) and (len(upper) == FRAME_LENGTH)
+        self.name = name
+        self.ps_voltage = ps_voltage
+        self.frequency = frequency
+        self.waveform = waveform
+        self.range = _range
+        self.lower = lower
+        self.upper = upper
+        self.settle = settle
+        self.hard = hard
+        
+        # Only the frame positions that have a bound need to be checked.
+        self.checked = [i for i in range(FRAME_LENGTH) if (lower[i] != float('-inf')) or (upper[i] != float('inf'))]
+    
+    def check(self, fg_measurements, dut_measurements, ps_voltage):
+        # Check a decoded measurement against the limits. Returns the labels of
+        # every value that is out of bounds.
+        frame = measurement_frame(fg_measurements, dut_measurements, ps_voltage)
+        lower = self.lower
+        upper = self.upper
+        return [FRAME_LABELS[i] for i in self.checked if not (lower[i] <= frame[i] <= upper[i])]
+
+def measurement_frame(fg_measurements, dut_measurements, ps_voltage):
+    # Flatten a measurement into the frame layout described by FRAME_LABELS.
+    assert (len(fg_measurements) == FRAME_SAMPLES) and (len(dut_measurements) == FRAME_SAMPLES)
+    frame = list(fg_measurements) + list(dut_measurements) + [ps_voltage]
+    for samples in (fg_measurements, dut_measurements):
+        frame.append(sum(samples) / FRAME_SAMPLES)
+        frame.append(max(samples) - min(samples))
+    return frame
+
+def load_plan(path):
+    # Read and compile a JSON test plan.
+    with open(path) as plan_file:
+        plan = json.load(plan_file)
+    return compile_plan(plan)
+
+def compile_plan(plan):
+    # Compile every test point of a test plan. Bad settings and limits are
+    # reported here, before any unit is tested.
+    try:
+        points = plan['test_points']
+    except (KeyError, TypeError) as e:
+        raise ValueError('Invalid test plan, expected a "test_points" list: %r' % e)
+    
+    # An empty or truncated plan would pass every part.
+    if not isinstance(points, list) or (len(points) == 0):
+        raise ValueError('Invalid test plan, "test_points" must be a non-empty list')
+    
+    test_points = []
+    for index, point in enumerate(points):
+        name = 'point %i' % (index + 1)
+        try:
+            name = point.get('name', name)
+            check_settings(point)
+            lower, upper = compile_limits(point.get('limits', {}))
+            test_points.append(TestPoint(name, point['ps_voltage'], point['frequency'], point['waveform'], point['range'],
+                lower, upper, settle=point.get('settle', 0), hard=point.get('hard', True)))
+        except (KeyError, TypeError, ValueError, AttributeError, AssertionError) as e:
+            raise ValueError('Invalid test point "%s": %r' % (name, e))
+    return test_points
+
+def check_settings(point):
+    # Check the programming values against what SIMPSDevice.program accepts.
+    # The powersupply is programmed in whole volts, so 12.5 would silently be 12.
+    ps_voltage = point['ps_voltage']
+    if not _is_number(ps_voltage) or (ps_voltage != int(ps_voltage)) or not (POWERSUPPLY_MIN <= ps_voltage <= POWERSUPPLY_MAX):
+        raise ValueError('ps_voltage %r not whole volts in range [%r, %r]' % (ps_voltage, POWERSUPPLY_MIN, POWERSUPPLY_MAX))
+    
+    _range = point['range']
+    if not _is_integer(_range) or (_range not in DUT_MEASUREMENT_RANGE_TABLE):
+        raise ValueError('range %r not one of %r' % (_range, sorted(DUT_MEASUREMENT_RANGE_TABLE)))
+    
+    frequency = point['frequency']
+    if not _is_integer(frequency) or not (0 < frequency <= FREQUENCY_MAX):
+        raise ValueError('frequency %r not an integer in range [1, %i]' % (frequency, FREQUENCY_MAX))
+    
+    waveform = point['waveform']
+    if not isinstance(waveform, list) or (len(waveform) != WAVEFORM_SAMPLES_PER_PERIOD):
+        raise ValueError('waveform needs %i values' % WAVEFORM_SAMPLES_PER_PERIOD)
+    for value in waveform:
+        if not _is_number(value) or not (-WAVEFORM_VREF <= value <= WAVEFORM_VREF):
+            raise ValueError('waveform value %r not in range [%r, %r]' % (value, -WAVEFORM_VREF, WAVEFORM_VREF))
+    
+    settle = point.get('settle', 0)
+    if not _is_number(settle) or not (0 <= settle < float('inf')):
+        raise ValueError('settle %r not a non-negative number of seconds' % (settle,))
+    
+    # A string such as "false" would be truthy, so only accept a real bool.
+    if not isinstance(point.get('hard', True), bool):
+        raise ValueError('hard %r not true or false' % (point['hard'],))
+
+def _is_integer(value):
+    # JSON true and false load as bools, which are also ints.
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+def compile_limits(limits):
+    # Turn a limits dictionary into lower and upper bound arrays.
+    lower = [float('-inf')] * FRAME_LENGTH
+    upper = [float('inf')] * FRAME_LENGTH
+    
+    for key in limits:
+        if key not in CHANNELS + ('ps',):
+            raise ValueError('unknown limit channel %r' % key)
+    
+    for offset, channel in enumerate(CHANNELS):
+        channel_limits = limits.get(channel, {})
+        for key in channel_limits:
+            if key not in ('samples',) + METRICS:
+                raise ValueError('unknown %s limit %r' % (channel, key))
+        
+        # Per-sample bounds.
+        start = offset*FRAME_SAMPLES
+        samples = channel_limits.get('samples', {})
+        _apply_bounds(lower, upper, start, FRAME_SAMPLES, samples, '%s samples' % channel)
+        
+        # Per-metric bounds.
+        for index, metric in enumerate(METRICS):
+            position = 2*FRAME_SAMPLES + 1 + offset*len(METRICS) + index
+            _apply_bounds(lower, upper, position, 1, channel_limits.get(metric, {}), '%s %s' % (channel, metric))
+    
+    _apply_bounds(lower, upper, 2*FRAME_SAMPLES, 1, limits.get('ps', {}), 'ps')
+    return lower, upper
+
+def _apply_bounds(lower, upper, start, length, bounds, name):
+    # A misspelled bound would silently pass every part, so reject it.
+    for key in bounds:
+        if key not in ('min', 'max'):
+            raise ValueError('unknown %s limit %r' % (name, key))
+    
+    for key, array in (('min', lower), ('max', upper)):
+        if key not in bounds: continue
+        values = bounds[key] if isinstance(bounds[key], list) else [bounds[key]] * length
+        if (len(values) != length): raise ValueError('expected %i %s values, got %i' % (length, key, len(values)))
+        for value in values:
+            if not _is_number(value) or math.isnan(value): raise ValueError('%s %s %r is not a number' % (name, key, value))
+        array[start:start+length] = [float(v) for v in values]
+    
+    # A bound with min above max would fail every part.
+    for i in range(start, start+length):
+        if (lower[i] > upper[i]):
+            raise ValueError('%s min %r is above max %r' % (name, lower[i], upper[i]))
+
+def test_unit(device, test_points, unit):
+    # Run a compiled test plan against one DUT and return its verdict record.
+    failures = []
+    points_run = 0
+    aborted = False
+    error = None
+    
+    try:
+        for point in test_points:
+            name = point.name
+            device.program(point.ps_voltage, point.frequency, point.waveform, point.range)
+            device.enable_ps()
+            device.enable_fg()
+            if point.settle: sleep(point.settle)
+            
+            fg_measurements, dut_measurements, ps_voltage = device.measurement()
+            points_run += 1
+            
+            failed = point.check(fg_measurements, dut_measurements, ps_voltage)
+            if failed:
+                failures.append({'point': point.name, 'failed': failed})
+                
+                # No need to spend bench time on the rest of a bad part.
+                if point.hard:
+                    aborted = True
+                    break
+    except Exception as e:
+        # Record the error and move on to the next unit instead of losing it.
+        error = '%s: %r' % (name, e)
+        aborted = True
+    finally:
+        # Always try to leave the outputs off.
+        try:
+            device.disable_fg()
+            device.disable_ps()
+        except Exception as e:
+            if not error: error = 'disabling outputs: %r' % e
+    
+    if error: verdict = VERDICT_ERROR
+    elif failures: verdict = VERDICT_FAIL
+    else: verdict = VERDICT_PASS
+    
+    record = {
+        'unit': unit,
+        'verdict': verdict,
+        'points_run': points_run,
+        'points_total': len(test_points),
+        'aborted': aborted,
+        'failures': failures
+    }
+    if error: record['error'] = error
+    return record
+
+def format_verdict(record):
+    # One line verdict for the console, i.e. "SN0042: FAIL (2/5) 12V 1kHz: dut.amplitude, ps"
+    line = '%s: %s (%i/%i)' % (record['unit'], record['verdict'], record['points_run'], record['points_total'])
+    failures = ['%s: %s' % (failure['point'], ', '.join(failure['failed'])) for failure in record['failures']]
+    if failures: line += ' ' + '; '.join(failures)
+    if ('error' in record): line += ' error: %s' % record['error']
+    return line
+
+def write_verdict(path, record):
+    # Append the verdict record to a JSON lines file.
+    with open(path, 'a') as verdict_file:
+        verdict_file.write(json.dumps(record, separators=(',', ':')) + '\n')